@@ -3,10 +3,14 @@ import asyncio
 import json
 import os
 import time
-from telegram.error import NetworkError
+import importlib.util
+import inspect
+import httpx
+from telegram.error import NetworkError, TimedOut
 from telegram import InputMediaPhoto, InputMediaVideo
 from telegram import InputMediaPhoto, InputMediaVideo, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     ContextTypes,
@@ -43,6 +47,29 @@ media_groups: Dict[str, List] = defaultdict(list)
 media_group_times: Dict[str, float] = {}
 MEDIA_GROUP_TIMEOUT = 300.0
 
+# Настройки HTTP-транспорта (можно переопределить переменными окружения)
+SEND_POOL_SIZE = int(os.getenv("SEND_POOL_SIZE", "64"))
+UPDATES_POOL_SIZE = int(os.getenv("UPDATES_POOL_SIZE", "2"))
+HTTP_VERSION = os.getenv("HTTP_VERSION", "2")
+KEEPALIVE_EXPIRY = float(os.getenv("KEEPALIVE_EXPIRY", "60"))
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", "30"))
+WRITE_TIMEOUT = float(os.getenv("WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.getenv("POOL_TIMEOUT", "10"))
+POOL_STATS_INTERVAL = float(os.getenv("POOL_STATS_INTERVAL", "300"))
+
+# Хранение лога пересылок (0 — без ограничения). Удалённые из лога сообщения
+# больше нельзя удалить, закрепить или открепить через бота
+LOG_MAX_AGE_DAYS = float(os.getenv("LOG_MAX_AGE_DAYS", "30"))
+LOG_MAX_PER_SOURCE = int(os.getenv("LOG_MAX_PER_SOURCE", "1000"))
+LOG_DROP_AFTER_DELETE = os.getenv("LOG_DROP_AFTER_DELETE", "1") == "1"
+LOG_COMPACT_INTERVAL = float(os.getenv("LOG_COMPACT_INTERVAL", "600"))
+
+# Проверка прав: запросов к API в секунду, повторов при сетевых ошибках и строк на сообщение
+AUDIT_RATE = max(float(os.getenv("AUDIT_RATE", "20")), 0.1)
+AUDIT_MAX_RETRIES = max(int(os.getenv("AUDIT_MAX_RETRIES", "3")), 0)
+AUDIT_PAGE_SIZE = max(int(os.getenv("AUDIT_PAGE_SIZE", "50")), 1)
+
 
 def load_json(filename):
     if os.path.exists(filename):
@@ -55,8 +82,11 @@ def load_json(filename):
 
 
 def save_json(filename, data):
-    with open(filename, "w", encoding="utf-8") as f:
+    # Пишем во временный файл и подменяем, чтобы читатель не увидел недописанный JSON
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_filename, filename)
 
 
 def load_config():
@@ -75,6 +105,205 @@ def save_log(log):
     save_json(MESSAGE_LOG_FILE, log)
 
 
+# Все изменения лога идут под этой блокировкой: обработчики и сжатие
+# перечитывают файл и меняют только свои ключи, не затирая чужие правки
+log_lock = asyncio.Lock()
+
+
+def set_log_key(key, entries):
+    log_data = load_log()
+    if entries is None:
+        log_data.pop(key, None)
+    else:
+        log_data[key] = entries
+    save_log(log_data)
+
+
+async def update_log_key(key, entries):
+    async with log_lock:
+        await asyncio.to_thread(set_log_key, key, entries)
+
+
+def log_entry_source(key, entries):
+    for entry in entries:
+        if isinstance(entry, dict) and "src" in entry:
+            return str(entry["src"])
+    # Старые записи альбомов: ключ вида "<источник>_<id>"
+    if "_" in key:
+        return key.rsplit("_", 1)[0]
+    return ""
+
+
+def find_expired_log_keys(log_data, now):
+    """Возвращает ключи лога, которые нужно удалить по правилам хранения."""
+    expired = set()
+    by_source = defaultdict(list)
+
+    for key, entries in log_data.items():
+        if not isinstance(entries, list):
+            expired.add(key)
+            continue
+        dict_entries = [entry for entry in entries if isinstance(entry, dict)]
+        # Записи без отметки времени считаем свежими, чтобы не потерять их сразу
+        ts = max((entry.get("ts", now) for entry in dict_entries), default=now)
+        if not entries or (LOG_MAX_AGE_DAYS > 0 and now - ts > LOG_MAX_AGE_DAYS * 86400):
+            expired.add(key)
+            continue
+        source = log_entry_source(key, entries)
+        # Старые одиночные записи без источника ограничиваются только по возрасту,
+        # иначе все они попали бы под один общий лимит
+        if source:
+            # Старые записи действительно старше любых новых, поэтому вытесняются первыми
+            legacy = any(entry.get("legacy") for entry in dict_entries)
+            by_source[source].append((not legacy, ts, key))
+
+    if LOG_MAX_PER_SOURCE > 0:
+        for items in by_source.values():
+            if len(items) > LOG_MAX_PER_SOURCE:
+                items.sort()
+                expired.update(key for _, _, key in items[:-LOG_MAX_PER_SOURCE])
+
+    return expired
+
+
+def compact_log_file(now):
+    log_data = load_log()
+    changed = False
+
+    for key, entries in log_data.items():
+        if not isinstance(entries, list):
+            continue
+        valid = [entry for entry in entries if isinstance(entry, dict)]
+        # Старым записям проставляем время, чтобы они тоже устаревали по возрасту,
+        # и помечаем их, чтобы лимит на источник вытеснял их раньше новых
+        for entry in valid:
+            if "ts" not in entry:
+                entry["ts"] = now
+                entry["legacy"] = True
+                changed = True
+        if len(valid) != len(entries):
+            log_data[key] = valid
+            changed = True
+
+    expired = find_expired_log_keys(log_data, now)
+    for key in expired:
+        log_data.pop(key, None)
+
+    if expired or changed:
+        save_log(log_data)
+    return len(expired), len(log_data)
+
+
+async def compact_log():
+    # Чтение, отбор и запись лога целиком выполняются в отдельном потоке
+    async with log_lock:
+        removed, remaining = await asyncio.to_thread(compact_log_file, time.time())
+    if removed:
+        logger.info(f"Лог пересылок сжат: удалено {removed} записей, осталось {remaining}")
+    return removed
+
+
+async def log_compaction_loop():
+    while True:
+        try:
+            await compact_log()
+        except Exception as e:
+            logger.exception("Ошибка compact_log: %s", e)
+        await asyncio.sleep(LOG_COMPACT_INTERVAL)
+
+
+class PoolStatsRequest(HTTPXRequest):
+    """HTTPXRequest со статистикой одновременных запросов и таймаутов пула.
+
+    Признак насыщения пула — таймауты ожидания свободного соединения:
+    при HTTP/2 много запросов делят одно соединение, поэтому число
+    одновременных запросов само по себе занятость пула не показывает.
+    Пик и таймауты считаются за интервал, который раз в POOL_STATS_INTERVAL
+    записывается в лог и сбрасывается задачей pool_stats_loop.
+    """
+
+    def __init__(self, name, pool_size, **kwargs):
+        super().__init__(connection_pool_size=pool_size, **kwargs)
+        self.name = name
+        self.pool_size = pool_size
+        self.concurrent = 0
+        self.total_requests = 0
+        self.pool_timeouts = 0
+        self.interval_start = time.time()
+        self.interval_requests = 0
+        self.interval_peak = 0
+        self.interval_pool_timeouts = 0
+
+    async def do_request(self, *args, **kwargs):
+        self.concurrent += 1
+        self.total_requests += 1
+        self.interval_requests += 1
+        self.interval_peak = max(self.interval_peak, self.concurrent)
+        try:
+            return await super().do_request(*args, **kwargs)
+        except TimedOut as e:
+            if "Pool timeout" in str(e):
+                self.pool_timeouts += 1
+                self.interval_pool_timeouts += 1
+                logger.warning(f"Пул соединений '{self.name}' переполнен ({self.pool_size} соединений)")
+            raise
+        finally:
+            self.concurrent -= 1
+
+    def stats_text(self):
+        elapsed = max(time.time() - self.interval_start, 1.0)
+        return (f"{self.name} (пул {self.pool_size}): за {int(elapsed)} сек "
+                f"{self.interval_requests} запросов, до {self.interval_peak} одновременно, "
+                f"таймаутов пула {self.interval_pool_timeouts} (всего {self.pool_timeouts})")
+
+    def reset_interval(self):
+        self.interval_start = time.time()
+        self.interval_requests = 0
+        self.interval_peak = self.concurrent
+        self.interval_pool_timeouts = 0
+
+
+request_pools: List[PoolStatsRequest] = []
+
+
+def resolve_http_version():
+    if HTTP_VERSION == "2" and importlib.util.find_spec("h2") is None:
+        logger.warning("Пакет h2 не установлен (pip install httpx[http2]), использую HTTP/1.1")
+        return "1.1"
+    return HTTP_VERSION
+
+
+async def pool_stats_loop():
+    while True:
+        await asyncio.sleep(POOL_STATS_INTERVAL)
+        for pool in request_pools:
+            logger.info(pool.stats_text())
+            pool.reset_interval()
+
+
+def build_request(name, pool_size, http_version):
+    kwargs = dict(
+        read_timeout=READ_TIMEOUT,
+        write_timeout=WRITE_TIMEOUT,
+        connect_timeout=CONNECT_TIMEOUT,
+        pool_timeout=POOL_TIMEOUT,
+        http_version=http_version,
+    )
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    # httpx_kwargs появился в python-telegram-bot 21.6
+    if "httpx_kwargs" in inspect.signature(HTTPXRequest.__init__).parameters:
+        kwargs["httpx_kwargs"] = {"limits": limits}
+    else:
+        logger.warning("python-telegram-bot < 21.6: KEEPALIVE_EXPIRY не применяется")
+    request = PoolStatsRequest(name, pool_size, **kwargs)
+    request_pools.append(request)
+    return request
+
+
 def main_menu_keyboard():
     keyboard = [
         [KeyboardButton("Добавить источник")],
@@ -123,9 +352,8 @@ async def process_media_group(group_id, context, target_chats, source_chat_id, d
 
         messages_sorted = sorted(messages, key=lambda m: m.message_id)
 
-        log_data = load_log()
         group_log_key = f"{source_chat_id}_{messages_sorted[0].message_id}"
-        log_data[group_log_key] = []
+        group_log_entries = []
 
         for target in target_chats:
             target_for_api = normalize_chat_for_api(target)
@@ -145,14 +373,15 @@ async def process_media_group(group_id, context, target_chats, source_chat_id, d
                     await asyncio.sleep(0.1)
 
                 for sent_msg in sent_messages:
-                    log_data[group_log_key].append({"chat": target_for_api, "msg_id": sent_msg.message_id})
+                    group_log_entries.append({"chat": target_for_api, "msg_id": sent_msg.message_id,
+                                              "src": source_chat_id, "ts": time.time()})
 
                 print(f"[INFO] Альбом из {len(messages_sorted)} медиа обработан для {target}")
 
             except Exception as e:
                 logger.error(f"Ошибка отправки медиагруппы в {target}: {e}")
 
-        save_log(log_data)
+        await update_log_key(group_log_key, group_log_entries)
 
     except Exception as e:
         logger.exception("Ошибка в process_media_group: %s", e)
@@ -253,6 +482,10 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 targets = d.get("targets", [])
                 delay = d.get("delay", 0)
             s += f"Источник: `{src}` — {len(targets)} целей, задержка: {delay} сек\n"
+        if request_pools:
+            s += "\nПулы соединений:\n"
+            for pool in request_pools:
+                s += pool.stats_text() + "\n"
         await update.message.reply_text(s, parse_mode="Markdown", reply_markup=main_menu_keyboard())
         return SELECT_ACTION
 
@@ -366,8 +599,7 @@ async def forward_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(f"[INFO] Будет отправлено через {delay} сек (источник {incoming_chat_id})")
         await asyncio.sleep(delay)
 
-    log_data = load_log()
-    log_data[str(msg.message_id)] = []
+    log_entries = []
 
     for target in targets:
         try:
@@ -377,14 +609,15 @@ async def forward_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
             sent_message = await msg.forward(chat_id=target_api)
 
             if sent_message:
-                log_data[str(msg.message_id)].append({"chat": target, "msg_id": sent_message.message_id})
+                log_entries.append({"chat": target, "msg_id": sent_message.message_id,
+                                    "src": incoming_chat_id, "ts": time.time()})
 
             await asyncio.sleep(0.12)  # Anti-flood
 
         except Exception as e:
             logger.error(f"Ошибка отправки в {target}: {e}")
 
-    save_log(log_data)
+    await update_log_key(str(msg.message_id), log_entries)
 
 
 
@@ -414,6 +647,9 @@ async def delete_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning(f"Ошибка удаления из {entry['chat']}: {error_msg}")
             failed_chats.append(f"{entry['chat']}: {error_msg}")
 
+    if LOG_DROP_AFTER_DELETE and not failed_chats:
+        await update_log_key(original_id, None)
+
     result_message = f"Удалено {deleted} сообщений.\n"
     if failed_chats:
         result_message += f"\nНе удалось удалить в {len(failed_chats)} чатах:\n"
@@ -596,64 +832,161 @@ async def unpin_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SELECT_ACTION
 
 
+class RateLimiter:
+    """Пропускает не больше rate запросов в секунду, равномерно распределяя их."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            # pause() может сдвинуть next_time, пока мы спим, поэтому проверяем заново
+            while self.next_time > time.monotonic():
+                await asyncio.sleep(self.next_time - time.monotonic())
+            self.next_time = time.monotonic() + self.interval
+
+    def pause(self, seconds):
+        # Ограничение флуда действует на всего бота, поэтому ждут все запросы сразу
+        self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+async def check_target_permissions(context, target, limiter):
+    target_api = normalize_chat_for_api(target)
+    attempt = 0
+    while True:
+        await limiter.wait()
+        try:
+            member = await context.bot.get_chat_member(target_api, context.bot.id)
+            break
+        except RetryAfter as e:
+            # Ожидание по RetryAfter не считается попыткой: его задаёт общий лимитер
+            limiter.pause(int(getattr(e, "retry_after", 5)) + 1)
+        except NetworkError as e:
+            attempt += 1
+            if attempt > AUDIT_MAX_RETRIES:
+                return target, f"Ошибка доступа - {str(e)}", ["нет доступа"]
+        except Exception as e:
+            return target, f"Ошибка доступа - {str(e)}", ["нет доступа"]
+
+    missing = []
+    permissions = []
+    if member.status != "administrator":
+        permissions.append("Не администратор")
+        missing.append("не администратор")
+    else:
+        if member.can_pin_messages:
+            permissions.append("Может закреплять")
+        else:
+            permissions.append("Не может закреплять")
+            missing.append("закрепление")
+
+        if member.can_delete_messages:
+            permissions.append("Может удалять")
+        else:
+            permissions.append("Не может удалять")
+            missing.append("удаление")
+
+    return target, ", ".join(permissions), missing
+
+
+async def safe_reply_text(update, text, **kwargs):
+    for attempt in range(AUDIT_MAX_RETRIES + 1):
+        try:
+            return await update.message.reply_text(text, **kwargs)
+        except RetryAfter as e:
+            if attempt == AUDIT_MAX_RETRIES:
+                raise
+            await asyncio.sleep(int(getattr(e, "retry_after", 5)) + 1)
+
+
+class ReportPager:
+    """Отправляет строки отчёта сообщениями по AUDIT_PAGE_SIZE строк, не длиннее 4000 символов."""
+
+    def __init__(self, update, header):
+        self.update = update
+        self.header = header
+        self.lines = []
+        self.length = 0
+
+    async def add(self, line):
+        if self.lines and (len(self.lines) >= AUDIT_PAGE_SIZE or self.length + len(line) > 4000):
+            await self.flush()
+        self.lines.append(line)
+        self.length += len(line) + 1
+
+    async def flush(self, **kwargs):
+        if self.lines:
+            await safe_reply_text(self.update, self.header + "\n".join(self.lines), **kwargs)
+        self.lines = []
+        self.length = 0
+
+
 async def check_bot_permissions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     config = load_config()
     if not config:
         await update.message.reply_text("Настроек нет. Сначала добавьте источник и цели.")
         return SELECT_ACTION
 
-    permission_results = []
-
+    # Одна и та же цель может быть указана у нескольких источников — проверяем её один раз
+    unique_targets = {}
     for source_chat_id, settings in config.items():
         if isinstance(settings, list):
             targets = settings
         else:
             targets = settings.get("targets", [])
-
         for target in targets:
-            try:
-                target_api = normalize_chat_for_api(target)
-                chat = await context.bot.get_chat(target_api)
-                member = await context.bot.get_chat_member(chat.id, context.bot.id)
-
-                permissions = []
-                if member.status != "administrator":
-                    permissions.append("Не администратор")
-                else:
-                    if member.can_pin_messages:
-                        permissions.append("Может закреплять")
-                    else:
-                        permissions.append("Не может закреплять")
+            unique_targets.setdefault(str(normalize_chat_for_api(target)), target)
 
-                    if member.can_delete_messages:
-                        permissions.append("Может удалять")
-                    else:
-                        permissions.append("Не может удалять")
-
-                permission_results.append(f"{target}: {', '.join(permissions)}")
+    if not unique_targets:
+        await update.message.reply_text("Нет целевых чатов для проверки.")
+        return SELECT_ACTION
 
-            except Exception as e:
-                permission_results.append(f"{target}: Ошибка доступа - {str(e)}")
+    await safe_reply_text(update, f"Проверяю права бота в {len(unique_targets)} чатах...")
 
-            await asyncio.sleep(0.5)
+    limiter = RateLimiter(AUDIT_RATE)
+    tasks = [asyncio.create_task(check_target_permissions(context, target, limiter))
+             for target in unique_targets.values()]
 
-    if permission_results:
-        message = "**Права бота в целевых чатах:**\n\n" + "\n".join(permission_results)
-        if len(message) > 4000:
-            parts = [message[i:i + 4000] for i in range(0, len(message), 4000)]
-            for part in parts:
-                await update.message.reply_text(part, parse_mode="Markdown")
-        else:
-            await update.message.reply_text(message, parse_mode="Markdown")
+    report = ReportPager(update, "Права бота в целевых чатах:\n\n")
+    problems = []
+    try:
+        for done in asyncio.as_completed(tasks):
+            target, permissions, missing = await done
+            if missing:
+                problems.append(f"{target}: {', '.join(missing)}")
+            await report.add(f"{target}: {permissions}")
+        await report.flush()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    summary = f"Проверено чатов: {len(unique_targets)}.\n"
+    if problems:
+        summary_pager = ReportPager(update, summary + f"Не хватает прав в {len(problems)} чатах:\n\n")
+        for i, problem in enumerate(problems, 1):
+            await summary_pager.add(f"{i}. {problem}")
+        await summary_pager.flush(reply_markup=main_menu_keyboard())
     else:
-        await update.message.reply_text("Нет целевых чатов для проверки.")
+        summary += "Во всех чатах есть права на закрепление и удаление."
+        await safe_reply_text(update, summary, reply_markup=main_menu_keyboard())
 
     return SELECT_ACTION
 
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    http_version = resolve_http_version()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(build_request("Отправка", SEND_POOL_SIZE, http_version))
+        .get_updates_request(build_request("Получение", UPDATES_POOL_SIZE, http_version))
+        .build()
+    )
     asyncio.get_event_loop().create_task(cleanup_old_media_groups())
+    asyncio.get_event_loop().create_task(log_compaction_loop())
+    asyncio.get_event_loop().create_task(pool_stats_loop())
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],